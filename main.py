@@ -1,78 +1,200 @@
+import ipaddress
 import logging
+import logging.handlers
+import math
 import os
+import random
 import urllib.request
 import sys
+import time
 
+import dns.resolver
 from datetime import datetime
 from dotenv import load_dotenv
-from cloudflare import Cloudflare
-from cloudflare.types.dns import ARecord, CNAMERecord
+from cloudflare import NOT_GIVEN, Cloudflare
 
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
 
 log_file = os.path.join(os.path.dirname(__file__), "py_logs.log")
-log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
 
-file_handler = logging.FileHandler(log_file, mode="w", encoding="utf-8")
-file_handler.setFormatter(log_formatter)
+ip_file = os.path.join(os.path.dirname(__file__), "ip.txt")
 
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(log_formatter)
+# Retries for throttled (429) or failed (408/409/5xx) Cloudflare API requests,
+# with exponential backoff and jitter done by the SDK
+MAX_RETRIES = 4
 
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+# Maximum number of record changes per batch request (Free plan limit)
+BATCH_SIZE = 200
 
-load_dotenv()
+# Number of DNS records requested per page when listing a zone
+RECORDS_PER_PAGE = 5000
+
+# Server-side `type` filter sent by `fetch_dns_records` for each record type
+RECORD_TYPES = {
+    "ALL": NOT_GIVEN,
+    "A": "A",
+    "CNAME": "CNAME",
+}
+
+
+def setup_logging():
+    """
+    Configures the root logger to write to the log file and to stdout.
+
+    Console output is buffered and flushed at exit, or as soon as an error is
+    logged, instead of flushing stdout after every record.
+    """
+    logger.setLevel(logging.INFO)
+    log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+
+    file_handler = logging.FileHandler(log_file, mode="w", encoding="utf-8")
+    file_handler.setFormatter(log_formatter)
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(log_formatter)
+    buffered_console_handler = logging.handlers.MemoryHandler(
+        capacity=128, flushLevel=logging.ERROR, target=console_handler
+    )
+
+    logger.addHandler(file_handler)
+    logger.addHandler(buffered_console_handler)
+
+
+def get_public_ip_dns() -> str:
+    """
+    Retrieves the external IP address of the machine from OpenDNS.
+
+    Resolving `myip.opendns.com` against the OpenDNS resolvers takes a single
+    UDP round trip, which is much cheaper than an HTTPS request.
+
+    Returns:
+        str: The external IP address
+    """
+    resolver = dns.resolver.Resolver(configure=False)
+    resolver.nameservers = ["208.67.222.222", "208.67.220.220"]
+    answer = resolver.resolve("myip.opendns.com", "A", lifetime=5)
+    return answer[0].to_text()
 
-ip_file = os.path.join(os.path.dirname(__file__), "ip.txt")
+
+def get_public_ip_http(url: str) -> str:
+    """
+    Retrieves the external IP address of the machine from a plain-text HTTP
+    service.
+
+    Args:
+        url (str): The URL of the service, which must answer with an IPv4
+            address
+
+    Returns:
+        str: The external IP address
+
+    Raises:
+        ValueError: If the response is not a valid IPv4 address
+    """
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return str(ipaddress.IPv4Address(response.read(64).decode().strip()))
 
 
 def get_public_ip() -> str:
     """
     Retrieves the external IP address of the machine.
 
+    OpenDNS is queried first, falling back to the `ipify.org` API if the DNS
+    lookup fails.
+
     Returns:
         str: The external IP address
     """
     try:
-        url = "https://api.ipify.org"  # IPv4 only
-        response = urllib.request.urlopen(url, timeout=5)
-        external_ip = response.read().decode("utf-8")
+        external_ip = get_public_ip_dns()
+        logger.info(f"Current IP: {external_ip}")
+        return external_ip
+    except Exception as e:
+        logger.warning(f"DNS lookup failed, falling back to ipify: {e}")
+    try:
+        external_ip = get_public_ip_http("https://api.ipify.org")  # IPv4 only
         logger.info(f"Current IP: {external_ip}")
         return external_ip
+    except ValueError as e:
+        logger.error(f"Invalid IP address received from ipify: {e}")
+        return
     except Exception as e:
-        logger.error(f"Error: {e.reason.strerror}")
+        logger.error(f"Error: {e}")
         return
 
 
+def confirm_public_ip(ip: str) -> bool:
+    """
+    Checks a new external IP address against a second, independent service.
+
+    Only called when the IP address looks changed, so that a single wrong
+    answer does not trigger an update of every DNS record.
+
+    Args:
+        ip (str): The external IP address to confirm
+
+    Returns:
+        bool: False if the second service reports a different or invalid IP
+              address, True otherwise (including when it cannot be reached)
+    """
+    try:
+        confirmed_ip = get_public_ip_http("https://ipv4.icanhazip.com")
+    except ValueError as e:
+        logger.error("Invalid IP address received from icanhazip: %s", e)
+        return False
+    except Exception as e:
+        logger.warning("Could not confirm IP address with icanhazip: %s", e)
+        return True
+    if confirmed_ip != ip:
+        logger.error("IP addresses do not match: %s != %s", ip, confirmed_ip)
+        return False
+    return True
+
+
 def ip_has_changed() -> tuple[bool, str]:
     """
-    Checks if the external IP address has changed since the last run and
-    updates it.
+    Checks if the external IP address has changed since the last run.
+
+    The cache is not updated here; call `save_ip` once the DNS records have
+    been updated so that a failed update is retried on the next run.
 
     Returns:
         bool: True and the new IP address if the IP address has changed,
               False otherwise
     """
     try:
-        with open(ip_file, "r") as f:
-            old_ip = f.read().strip()
-            logger.info(f"Old IP: {old_ip}")
+        old_ip = None
+        if os.path.exists(ip_file):
+            with open(ip_file, "r") as f:
+                old_ip = f.read().strip()
+                logger.info(f"Old IP: {old_ip}")
         new_ip = get_public_ip()
+        if new_ip is None:
+            return False, None
         if old_ip == new_ip:
             logger.info("IP address has not changed")
             return False, None
-        with open(ip_file, "w") as f:
-            f.write(new_ip)
-        logger.info("Saving new IP address to cache")
+        if not confirm_public_ip(new_ip):
+            return False, None
         return True, new_ip
     except Exception as e:
-        logger.error(f"Error: {e.reason.strerror}")
+        logger.error(f"Error: {e}")
         return False, None
 
 
+def save_ip(ip: str):
+    """
+    Saves the IP address to the cache file.
+
+    Args:
+        ip (str): The IP address the DNS records now point to
+    """
+    with open(ip_file, "w") as f:
+        f.write(ip)
+    logger.info("Saving new IP address to cache")
+
+
 def fetch_dns_records(cf: Cloudflare, zone_id: str, type: str = "A") -> list:
     """
     Fetches the DNS records for the specified zone.
@@ -86,62 +208,119 @@ def fetch_dns_records(cf: Cloudflare, zone_id: str, type: str = "A") -> list:
     Returns:
         list: A list of DNS records
     """
-    record_types = {
-        "ALL": lambda record: True,
-        "A": lambda record: isinstance(record, ARecord),
-        "CNAME": lambda record: isinstance(record, CNAMERecord),
-    }
-    filter_func = record_types.get(type, None)
-    if filter_func is None:
+    if type not in RECORD_TYPES:
         raise ValueError(f"Invalid record type: {type}")
 
-    records = cf.dns.records.list(zone_id=zone_id)
-    logger.info(f"DNS records fetched: {len(list(records))}")
+    logger.info("Fetching records by type: %s", type)
+    records = []
+    page = cf.dns.records.list(
+        zone_id=zone_id, type=RECORD_TYPES[type], per_page=RECORDS_PER_PAGE
+    )
+    while True:
+        records.extend(page.result or [])
+        # A short page is the last one; the SDK paginator would otherwise
+        # request one more, empty page to find out
+        per_page = page.result_info.per_page if page.result_info else None
+        if not page.result or (per_page and len(page.result) < per_page):
+            break
+        page = page.get_next_page()
+    if logger.isEnabledFor(logging.DEBUG):
+        for record in records:
+            logger.debug("Record: %r", record)
+    logger.info("DNS records fetched: %d", len(records))
 
-    logger.info(f"Filtering records by type: {type}")
-    filtered_records = [record for record in records if filter_func(record)]
-    logging.debug(f"Filtered records: {filtered_records}")
-    logger.info(f"DNS records filtered: {len(filtered_records)}")
+    return records
 
-    return filtered_records
 
-
-def update_dns_records(cf: Cloudflare, records: list, zone_id: str, ip: str):
+def update_dns_records(cf: Cloudflare, records: list, zone_id: str, ip: str) -> bool:
     """
     Updates the DNS records for the specified domain.
 
+    Changed records are sent to the batch DNS records endpoint, in requests of
+    up to `BATCH_SIZE` records, instead of issuing one request per record.
+
     Args:
         cf (Cloudflare): An instance of the Cloudflare class
         records (list): A list of DNS records to update
         zone_id (str): The ID of the Cloudflare zone
         ip (str): The new IP address to set for the DNS records
+
+    Returns:
+        bool: True if all records point to the new IP address, False otherwise
     """
-    for record in records:
-        logging.debug(f"Updating record: {record}")
-        if record.content == ip:
-            logger.info(f"No changes needed for {record.name}")
-            continue
-        try:
-            cf.dns.records.update(
-                dns_record_id=record.id,
-                zone_id=zone_id,
-                content=ip,
-                name=record.name,
-                type=record.type,
-                ttl=record.ttl,
-                comment=f"Updated by rpi-cloudflare-ddns on {datetime.now()}",
+    stale_records = [record for record in records if record.content != ip]
+    logger.info("No changes needed for %d records", len(records) - len(stale_records))
+    if not stale_records:
+        return True
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    comment = "Updated by rpi-cloudflare-ddns on " + datetime.now().isoformat(
+        timespec="seconds"
+    )
+    patches = []
+    for record in stale_records:
+        if debug:
+            logger.debug("Updating record: %s", record)
+        patches.append(
+            {
+                "id": record.id,
+                "content": ip,
+                "name": record.name,
+                "type": record.type,
+                "ttl": record.ttl,
+                "comment": comment,
+            }
+        )
+
+    try:
+        # cloudflare 3.1.0 has no dns.records.batch helper, so the endpoint is
+        # called directly
+        for i in range(0, len(patches), BATCH_SIZE):
+            cf.post(
+                f"/zones/{zone_id}/dns_records/batch",
+                cast_to=object,
+                body={"patches": patches[i : i + BATCH_SIZE]},
             )
-        except Exception as e:
-            logger.error(f"Error: {e.reason.strerror}")
+    except Exception as e:
+        logger.error("Error: %s", e)
+        return False
+    logger.info(
+        "Updated %d records: %s", len(patches), ", ".join(p["name"] for p in patches)
+    )
+    return True
+
+
+def sleep_jitter():
+    """
+    Sleeps for a random delay of up to `UPDATE_JITTER` seconds (defaults to 0).
+
+    Spreads out the Cloudflare API calls of clients scheduled on the same cron
+    boundary.
+    """
+    try:
+        max_delay = float(os.getenv("UPDATE_JITTER") or 0)
+        if not math.isfinite(max_delay):
+            raise ValueError(f"not a finite number: {max_delay}")
+    except ValueError as e:
+        logger.warning("Ignoring invalid UPDATE_JITTER value: %s", e)
+        max_delay = 0
+    if max_delay > 0:
+        delay = random.uniform(0, max_delay)
+        logger.info("Waiting %.1fs before updating DNS records", delay)
+        time.sleep(delay)
 
 
 def main():
+    load_dotenv()
+    setup_logging()
     has_changed, ip = ip_has_changed()
     if has_changed:
-        cf = Cloudflare()
+        sleep_jitter()
+        cf = Cloudflare(max_retries=MAX_RETRIES)
         dns_records = fetch_dns_records(cf, os.getenv("ZONE_ID"), type="A")
-        update_dns_records(cf, dns_records, os.getenv("ZONE_ID"), ip=ip)
-        logger.info("DNS records updated successfully")
+        if update_dns_records(cf, dns_records, os.getenv("ZONE_ID"), ip=ip):
+            save_ip(ip)
+            logger.info("DNS records updated successfully")
 
 
 if __name__ == "__main__":